@@ -1,6 +1,12 @@
 #----------------------------------------
 #ATMOSPHERE_TEMPERATURE_PROFILE FUNCTIONS
 #----------------------------------------
+import itertools
+import multiprocessing
+import weakref
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing import shared_memory
 import numpy as np
 
     
@@ -314,56 +320,34 @@ def clouds_optical_depth(ch_ir = np.zeros(51), ch_sw = np.zeros(51), z_top_a = 5
                                                                                                                                      
     return ch_ir_c, ch_sw_c
         
-def temperature_profile(ch_ir, ch_sw):
-    """This function computes the atmospheric temperature vector in an
-       equilibrium situation.
+def ir_exchange_matrix(ch_ir):
+    """This function computes the M matrix of the radiative exchange between
+       the layers in the IR region.
+       
+       The matrix depends only on the IR optical depth, so every column
+       sharing the same ch_ir can reuse it with a different SW forcing.
        
        INPUT:
            ch_ir  : Total optical depth vector in the IR region.
-           ch_sw  : Total optical depth vector in the SW region.
            
        OUTPUT:
-           T : Atmospheric temperature vector, gives the temperature at each
-               level of the atmosphere.
+           M : (nlayer x nlayer) matrix such that irr_abs = M*(sigma*T^4).
 
                                                                         """
-            
-    if (len(ch_ir) != len(ch_sw)):
-        raise ValueError('The length of ch_ir and ch_sw must to be equal!')
-        
-    if (len(ch_sw[ch_sw < 0]) != 0) or (len(ch_ir[ch_ir < 0]) != 0):
-        raise ValueError('ch_ir or ch_sw contain negative elements!')
-        
-    #Definition of the fixed value
-    albedo = 0.3                 #Planetary albedo
-    TSI = (1 - albedo) * 1370/4  #Total solar irradiance at the atmosphere top
-    sigma = 5.6704e-8            # [W/(m^2k^4)] Stefan Boltzmann Costant   
-    
     #nlayer must to be an intereg value
     nlayer = len(ch_ir)
     
-    #Calculation of the comulative optical depth (total OD) in the ir
-    #and sw region. Total OD is evaluated as the comulative sum of the OD vectors        
-    tot_ch_ir = np.zeros(nlayer)
-    tot_ch_sw = np.zeros(nlayer)
-    
-    tot_ch_ir[1:nlayer] = np.cumsum(ch_ir[0:nlayer-1])
-    tot_ch_sw[1:nlayer] = np.cumsum(ch_sw[0:nlayer-1])
-    
-    #Computation the the transmittance in the ir and sw regions
+    #Computation the the transmittance in the ir region
     #The trasmittance is defined as T=e^(-OD)    
     trans_ir = np.exp(-ch_ir)
-    trans_sw = np.exp(-ch_sw)
     
     #The trasmittance of the last layer, which is associated withe the 
     #ground is set to 0, since the ground is considered a black body    
     trans_ir[nlayer - 1] = 0
-    trans_sw[nlayer - 1] = 0
     
     #Computation of the absorbance and the emissivity of the layer 
     #The emissivity is equal to the absorbance (Kirchhoff's law)    
     abs_ir = 1 - trans_ir #absorbance
-    abs_sw = 1 - trans_sw     
     emis_ir = abs_ir      #emissivity
     
     #Computation of the trasmissivity symmetric matrix     
@@ -373,27 +357,95 @@ def temperature_profile(ch_ir, ch_sw):
         for j in range(i + 2, nlayer):
             trasm_m_ir[i][j] = trasm_m_ir[i][j-1]*trans_ir[j-1]
             trasm_m_ir[j][i] = trasm_m_ir[i][j]
-            
-    #Computation of the total comulative trasmittance in the sw    
-    tot_trans_sw = np.exp(-tot_ch_sw)
-    
-    #Definition of the M matrix 
-    M= np.ones((nlayer,nlayer))
     
-    for i in range(nlayer):
-        for j in range(nlayer):
-            M[i][j] = trasm_m_ir[i][j]*emis_ir[j]*abs_ir[i]
+    #Definition of the M matrix, M[i][j] = trasm_m_ir[i][j]*emis_ir[j]*abs_ir[i]
+    M = trasm_m_ir*np.outer(abs_ir, emis_ir)
 
     for i in range(nlayer - 1):
         M[i][i] = -2*emis_ir[i]
     
     M[nlayer-1][nlayer-1] = -emis_ir[nlayer-1]
     
-    #Computation of the solar irradiance (sw) absorbed by the atmosphere
-    irr_abs = np.zeros(nlayer)
+    return M
+
+
+def sw_absorption_profile(ch_sw):
+    """This function computes the fraction of the solar irradiance (sw)
+       at the top of the atmosphere which is absorbed by each layer.
+       
+       The computation is done along the last axis, so ch_sw can be a
+       single column (nlayer) or a set of columns (ncol x nlayer).
+       
+       INPUT:
+           ch_sw  : Total optical depth vector in the SW region.
+           
+       OUTPUT:
+           sw_abs : absorbed fraction of the incoming irradiance per layer.
+
+                                                                        """
+    ch_sw = np.asarray(ch_sw, dtype = float)
+    nlayer = ch_sw.shape[-1]
+    
+    #Calculation of the comulative optical depth (total OD) in the sw region
+    tot_ch_sw = np.zeros(ch_sw.shape)
+    tot_ch_sw[..., 1:nlayer] = np.cumsum(ch_sw[..., 0:nlayer-1], axis = -1)
+    
+    #The trasmittance of the last layer (the ground) is set to 0
+    trans_sw = np.exp(-ch_sw)
+    trans_sw[..., nlayer - 1] = 0
+    abs_sw = 1 - trans_sw
+    
+    #Computation of the total comulative trasmittance in the sw    
+    tot_trans_sw = np.exp(-tot_ch_sw)
+    
+    sw_abs = tot_trans_sw*abs_sw
+    
+    return sw_abs
+
+        
+def temperature_profile(ch_ir, ch_sw, albedo = 0.3, insolation = 1370/4):
+    """This function computes the atmospheric temperature vector in an
+       equilibrium situation.
+       
+       (The default values are in parentheses)
+       
+       INPUT:
+           ch_ir      : Total optical depth vector in the IR region.
+           ch_sw      : Total optical depth vector in the SW region.
+           albedo     : Planetary albedo (0.3).
+           insolation : Solar irradiance at the atmosphere top in W/m^2,
+                        before the albedo reflection (1370/4, global mean).
+           
+       OUTPUT:
+           T : Atmospheric temperature vector, gives the temperature at each
+               level of the atmosphere.
+       
+       RAISE:
+           ValueError:
+               If ch_ir and ch_sw have different length
+               If ch_ir or ch_sw contain negative elements
+               If albedo is not in [0, 1] or insolation is negative
+
+                                                                        """
+            
+    if (len(ch_ir) != len(ch_sw)):
+        raise ValueError('The length of ch_ir and ch_sw must to be equal!')
+        
+    if (len(ch_sw[ch_sw < 0]) != 0) or (len(ch_ir[ch_ir < 0]) != 0):
+        raise ValueError('ch_ir or ch_sw contain negative elements!')
+        
+    if (albedo < 0 or albedo > 1 or insolation < 0):
+        raise ValueError('albedo must to be in [0, 1] and insolation >= 0!')
+        
+    #Definition of the fixed value
+    TSI = (1 - albedo) * insolation  #Total solar irradiance at the atmosphere top
+    sigma = 5.6704e-8            # [W/(m^2k^4)] Stefan Boltzmann Costant   
     
-    for i in range(nlayer):
-        irr_abs[i] = -TSI*tot_trans_sw[i]*abs_sw[i]
+    #Definition of the M matrix 
+    M = ir_exchange_matrix(ch_ir)
+    
+    #Computation of the solar irradiance (sw) absorbed by the atmosphere
+    irr_abs = -TSI*sw_absorption_profile(ch_sw)
     
     #The system that needs to be solved is:
     # irr_abs = M*(sigma*T^4) 
@@ -404,4 +456,1062 @@ def temperature_profile(ch_ir, ch_sw):
     
     T = (sT4/sigma)**0.25
     
-    return T
\ No newline at end of file
+    return T
+
+
+def column_insolation(latitude, declination = 0, hour_angle = None,
+                      solar_constant = 1370):
+    """ This function computes the solar irradiance at the top of the
+        atmosphere for a set of columns.
+        
+        If hour_angle is None the daily mean irradiance is returned, 
+        otherwise the instantaneous one. The inputs are broadcast together,
+        so a latitude x longitude (or latitude x time-of-day) grid is 
+        obtained passing latitude[:, None] and hour_angle[None, :].
+        
+        (The default values are in parentheses)
+        
+        INPUT:
+            latitude       : latitude of the columns in degrees.
+            declination    : solar declination in degrees (0, equinox).
+            hour_angle     : local hour angle in degrees, 0 at local noon 
+                             (None, daily mean).
+            solar_constant : Total solar irradiance in W/m^2 (1370).
+            
+        OUTPUT:
+            insolation : irradiance at the atmosphere top in W/m^2.
+        
+        RAISE:
+            ValueError:
+                If the latitude is outside [-90, 90]
+                If the solar_constant is negative
+                
+                                                                          """
+    latitude = np.asarray(latitude, dtype = float)
+    
+    if np.any(np.abs(latitude) > 90):
+        raise ValueError('The latitude must to be in [-90, 90]!')
+        
+    if solar_constant < 0:
+        raise ValueError('The solar_constant must to be >= 0!')
+    
+    phi = np.radians(latitude)
+    delta = np.radians(declination)
+    
+    if hour_angle is None:
+        #Hour angle of the sunset (0 for polar night, pi for polar day)
+        cos_h0 = np.clip(-np.tan(phi)*np.tan(delta), -1, 1)
+        h0 = np.arccos(cos_h0)
+        insolation = solar_constant/np.pi*(h0*np.sin(phi)*np.sin(delta) +
+                                           np.cos(phi)*np.cos(delta)*np.sin(h0))
+    else:
+        h = np.radians(hour_angle)
+        cos_zenith = (np.sin(phi)*np.sin(delta) +
+                      np.cos(phi)*np.cos(delta)*np.cos(h))
+        insolation = solar_constant*np.maximum(cos_zenith, 0)
+    
+    #the rounding errors can give small negative values at the terminator
+    insolation = np.maximum(insolation, 0)
+        
+    return insolation
+
+
+def _solve_column_group(ch_ir, irr_abs):
+    """ Solves the columns sharing the same ch_ir (irr_abs is ncol x nlayer)
+        with a single factorization of the M matrix.                    """
+    M = ir_exchange_matrix(ch_ir)
+    return np.linalg.solve(M, irr_abs.T).T
+
+
+def _solve_column_group_shared(spec, index, ch_ir, irr_abs):
+    """ Worker version of _solve_column_group, the solution is written in
+        the rows 'index' of the shared sT4 buffer.                      """
+    write_shared_result(spec, index, sT4 = _solve_column_group(ch_ir, irr_abs))
+
+
+def temperature_profile_columns(ch_ir, ch_sw, albedo = 0.3,
+                                insolation = 1370/4, processes = 1):
+    """This function computes the equilibrium temperature for a grid of
+       columns with different albedo and insolation.
+       
+       The columns with identical ch_ir share the M matrix, which is 
+       factorized only once: only the SW right-hand side changes between
+       them. If the gas profiles are shared (1D ch_ir) the whole grid is
+       solved with a single factorization. The groups of columns with a 
+       different ch_ir are distributed over 'processes' worker processes.
+       
+       (The default values are in parentheses)
+       
+       INPUT:
+           ch_ir      : IR optical depth, shape (nlayer) or grid + (nlayer).
+           ch_sw      : SW optical depth, shape (nlayer) or grid + (nlayer).
+           albedo     : albedo of the columns, scalar or grid shaped (0.3).
+           insolation : irradiance at the atmosphere top of the columns,
+                        scalar or grid shaped (1370/4). See column_insolation.
+           processes  : number of worker processes (1).
+           
+       OUTPUT:
+           T : temperature profiles, shape grid + (nlayer).
+       
+       RAISE:
+           ValueError:
+               If the inputs can not be broadcast to the same grid
+               If ch_ir or ch_sw contain negative elements
+               If albedo is not in [0, 1] or insolation is negative
+
+                                                                        """
+    ch_ir = np.asarray(ch_ir, dtype = float)
+    ch_sw = np.asarray(ch_sw, dtype = float)
+    albedo = np.asarray(albedo, dtype = float)
+    insolation = np.asarray(insolation, dtype = float)
+    
+    if ch_ir.shape[-1] != ch_sw.shape[-1]:
+        raise ValueError('The length of ch_ir and ch_sw must to be equal!')
+        
+    if np.any(ch_ir < 0) or np.any(ch_sw < 0):
+        raise ValueError('ch_ir or ch_sw contain negative elements!')
+        
+    if np.any(albedo < 0) or np.any(albedo > 1) or np.any(insolation < 0):
+        raise ValueError('albedo must to be in [0, 1] and insolation >= 0!')
+        
+    sigma = 5.6704e-8            # [W/(m^2k^4)] Stefan Boltzmann Costant
+    nlayer = ch_ir.shape[-1]
+    
+    grid_shape = np.broadcast_shapes(ch_ir.shape[:-1], ch_sw.shape[:-1],
+                                     albedo.shape, insolation.shape)
+    ncol = int(np.prod(grid_shape))
+    
+    #SW forcing of each column (the right-hand side of the system)
+    sw_abs = sw_absorption_profile(ch_sw)
+    sw_abs = np.broadcast_to(sw_abs, grid_shape + (nlayer,)).reshape(ncol, nlayer)
+    TSI = (1 - albedo)*insolation
+    TSI = np.broadcast_to(TSI, grid_shape).reshape(ncol)
+    irr_abs = -TSI[:, None]*sw_abs
+    
+    #Grouping of the columns with the same IR optical depth
+    if ch_ir.ndim == 1:
+        ch_ir_groups = ch_ir[None, :]
+        group = np.zeros(ncol, dtype = int)
+    else:
+        ch_ir = np.broadcast_to(ch_ir, grid_shape + (nlayer,)).reshape(ncol, nlayer)
+        ch_ir_groups, group = np.unique(ch_ir, axis = 0, return_inverse = True)
+        group = group.reshape(ncol)
+    
+    #Column indexes of each group, built in a single pass over the columns
+    order = np.argsort(group, kind = 'stable')
+    counts = np.bincount(group, minlength = len(ch_ir_groups))
+    index = np.split(order, np.cumsum(counts)[:-1])
+    
+    #The workers write their groups directly in a shared sT4 buffer
+    if processes > 1 and len(index) > 1:
+        with shared_result_buffers(ncol, nlayer, ('sT4',)) as (buffers, spec):
+            tasks = [(spec, index[g], ch_ir_groups[g], irr_abs[index[g]])
+                     for g in range(len(index))]
+            with multiprocessing.Pool(processes, 
+                                      initializer = attach_shared_results,
+                                      initargs = (spec,)) as pool:
+                pool.starmap(_solve_column_group_shared, tasks)
+            T = (buffers['sT4']/sigma)**0.25
+    else:
+        sT4 = np.zeros((ncol, nlayer))
+        for g in range(len(index)):
+            sT4[index[g]] = _solve_column_group(ch_ir_groups[g],
+                                                irr_abs[index[g]])
+        T = (sT4/sigma)**0.25
+    
+    return T.reshape(grid_shape + (nlayer,))
+
+
+
+def _close_segment(shm):
+    """ Closes a shared memory segment once no numpy view uses it.     """
+    try:
+        shm.close()
+    except BufferError:
+        pass
+    
+
+@contextmanager
+def shared_result_buffers(n_runs, nlayer, fields = ('T', 'ch_ir', 'ch_sw', 'z')):
+    """ Context manager that preallocates the (n_runs x nlayer) result 
+        arrays in shared memory, so that the workers of a process pool can
+        write their run directly in the parent arrays (see 
+        write_shared_result) instead of pickling them back.
+        
+        It yields the couple (buffers, spec): buffers is a dict with the 
+        numpy arrays of each field, spec is the small picklable description
+        that has to be sent to the workers.
+        
+        The segments are unlinked when the block exits, also if an error 
+        is raised, so nothing is left in the system. The arrays remain 
+        valid after the block as ordinary numpy arrays, and the memory is
+        released when the last view is deleted.
+        
+        (The default values are in parentheses)
+        
+        INPUT:
+            n_runs : number of runs (rows of the arrays).
+            nlayer : number of layers (columns of the arrays).
+            fields : names of the arrays (('T', 'ch_ir', 'ch_sw', 'z')).
+            
+        OUTPUT:
+            buffers : dict field -> (n_runs x nlayer) numpy array.
+            spec    : dict field -> (segment name, shape) for the workers.
+        
+        RAISE:
+            ValueError:
+                If n_runs or nlayer are smaller than 1
+                
+                                                                          """
+    if n_runs < 1 or nlayer < 1:
+        raise ValueError('n_runs and nlayer must be at least 1')
+    
+    shape = (int(n_runs), int(nlayer))
+    size = shape[0]*shape[1]*np.dtype(float).itemsize
+    segments = {}
+    buffers = {}
+    
+    try:
+        for field in fields:
+            segments[field] = shared_memory.SharedMemory(create = True, 
+                                                         size = size)
+            buffers[field] = np.ndarray(shape, dtype = float,
+                                        buffer = segments[field].buf)
+            buffers[field][:] = 0
+        
+        spec = {field: (segments[field].name, shape) for field in fields}
+        
+        yield buffers, spec
+        
+    finally:
+        for field, shm in segments.items():
+            shm.unlink()
+            if field in buffers:
+                weakref.finalize(buffers[field], _close_segment, shm)
+            else:
+                _close_segment(shm)
+            
+            
+#Shared memory segments mapped once in a worker process (name -> segment)
+_attached_segments = {}
+
+
+def attach_shared_results(spec):
+    """ This function maps the shared buffers of a spec in the current 
+        process, so that write_shared_result does not have to open the 
+        segments again at every run. It is meant to be used as initializer
+        of the process pool:
+        
+            multiprocessing.Pool(processes, initializer = attach_shared_results,
+                                 initargs = (spec,))
+        
+        INPUT:
+            spec : spec yielded by shared_result_buffers.
+                
+                                                                          """
+    for name, _ in spec.values():
+        if name not in _attached_segments:
+            _attached_segments[name] = shared_memory.SharedMemory(name = name)
+            
+            
+def detach_shared_results(spec):
+    """ This function closes the mappings made by attach_shared_results
+        in the current process.                                         
+                                                                          """
+    for name, _ in spec.values():
+        if name in _attached_segments:
+            _attached_segments.pop(name).close()
+            
+            
+def write_shared_result(spec, run, **values):
+    """ This function writes the results of a run in the shared buffers
+        created by shared_result_buffers. It is meant to be called by the
+        workers of a process pool.
+        
+        The segments mapped by attach_shared_results are reused, the other
+        ones are opened and closed at each call.
+        
+        INPUT:
+            spec     : spec yielded by shared_result_buffers.
+            run      : row index (or array of row indexes) of the run.
+            **values : field = array to write (example T = T, z = z).
+            
+        RAISE:
+            KeyError:
+                If a field is not in the spec
+                
+                                                                          """
+    for field, value in values.items():
+        name, shape = spec[field]
+        
+        if name in _attached_segments:
+            result = np.ndarray(shape, dtype = float, 
+                                buffer = _attached_segments[name].buf)
+            result[run] = value
+            del result
+            continue
+            
+        shm = shared_memory.SharedMemory(name = name)
+        try:
+            result = np.ndarray(shape, dtype = float, buffer = shm.buf)
+            result[run] = value
+            del result
+        finally:
+            shm.close()
+
+
+def _model_run_shared(spec, run, parameters):
+    """ Worker of parallel_model_runs: runs optical_depth and 
+        temperature_profile and writes the outputs in the shared buffers. """
+    ch_ir, ch_sw, z, T = _run_scenario(parameters)
+    
+    write_shared_result(spec, run, T = T, ch_ir = ch_ir, ch_sw = ch_sw, z = z)
+    
+    
+def parallel_model_runs(parameters, processes = 2):
+    """ This function runs optical_depth + temperature_profile for a list
+        of parameter sets over a process pool. The outputs are collected in
+        shared memory (see shared_result_buffers), without pickling them:
+        each worker maps the buffers once (attach_shared_results) and then
+        writes its runs in place.
+        
+        (The default values are in parentheses)
+        
+        INPUT:
+            parameters : list of scenario dicts (see model_pipeline). All
+                         the runs must have the same nlayer.
+            processes  : number of worker processes (2).
+            
+        OUTPUT:
+            T     : (n_runs x nlayer) temperature profiles.
+            ch_ir : (n_runs x nlayer) OD profiles in the IR region.
+            ch_sw : (n_runs x nlayer) OD profiles in the SW region.
+            z     : (n_runs x nlayer) height vectors in meters.
+        
+        RAISE:
+            ValueError:
+                If the runs have different nlayer
+                If parameters is empty
+                
+                                                                          """
+    if len(parameters) == 0:
+        raise ValueError('At least one run is needed!')
+    
+    nlayers = {int(run.get('nlayer', 51)) for run in parameters}
+    if len(nlayers) != 1:
+        raise ValueError('All the runs must have the same nlayer!')
+    nlayer = nlayers.pop()
+    
+    with shared_result_buffers(len(parameters), nlayer) as (buffers, spec):
+        tasks = [(spec, run, parameters[run]) for run in range(len(parameters))]
+        with multiprocessing.Pool(processes, initializer = attach_shared_results,
+                                  initargs = (spec,)) as pool:
+            pool.starmap(_model_run_shared, tasks)
+    
+    return buffers['T'], buffers['ch_ir'], buffers['ch_sw'], buffers['z']
+
+
+
+def _run_scenario(scenario):
+    """ Runs optical_depth -> clouds_optical_depth -> temperature_profile
+        for a scenario dict and returns ch_ir, ch_sw, z, T.              """
+    scenario = dict(scenario)
+    clouds = scenario.pop('clouds', 0)
+    cloud_position = scenario.pop('cloud_position', [8, 10])
+    k_cloud_LW = scenario.pop('k_cloud_LW', 0.001)
+    k_cloud_SW = scenario.pop('k_cloud_SW', 0)
+    albedo = scenario.pop('albedo', 0.3)
+    insolation = scenario.pop('insolation', 1370/4)
+    
+    ch_ir, ch_sw, z = optical_depth(**scenario)
+    
+    #if the cloud flag is equal to one it sum the cloud's contribute to OD
+    if clouds == 1:
+        ch_ir, ch_sw = clouds_optical_depth(ch_ir, ch_sw, 
+                                            scenario.get('z_top_a', 50),
+                                            cloud_position, k_cloud_LW,
+                                            k_cloud_SW)
+    elif clouds != 0:
+        raise ValueError("clouds flag must to be 0 (off) or 1(on)!")
+        
+    T = temperature_profile(ch_ir, ch_sw, albedo, insolation)
+    
+    return ch_ir, ch_sw, z, T
+
+
+def _run_scenario_batch(batch):
+    """ Worker of model_pipeline: runs a list of scenarios.            """
+    return [_run_scenario(scenario) for scenario in batch]
+
+
+def scenario_batches(scenarios, batch_size = 100):
+    """ This function groups a (possibly unbounded) iterable of scenarios
+        into lists of batch_size elements. The scenarios are read lazily,
+        one batch at a time.
+        
+        (The default values are in parentheses)
+        
+        INPUT:
+            scenarios  : iterable of scenarios.
+            batch_size : number of scenarios in each batch (100).
+            
+        OUTPUT:
+            generator of lists of scenarios (the last one can be shorter).
+        
+        RAISE:
+            ValueError:
+                If batch_size < 1
+                
+                                                                          """
+    if batch_size < 1:
+        raise ValueError('The batch_size must be at least 1')
+    
+    def batches(iterator):
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if len(batch) == 0:
+                return
+            yield batch
+            
+    return batches(iter(scenarios))
+
+
+def model_pipeline(scenarios, batch_size = 100, processes = 1, 
+                   max_pending = None):
+    """ This function runs the chain optical_depth -> clouds_optical_depth
+        -> temperature_profile on a stream of scenarios and yields the
+        results lazily, in the same order of the scenarios.
+        
+        A scenario is a dict with the keyword arguments of optical_depth
+        plus, optionally:
+            clouds         : flag for the clouds, 1 == on, 0 == off (0).
+            cloud_position : position of the cloud in km ([8, 10]).
+            k_cloud_LW     : IR absorption coefficient of the cloud (0.001).
+            k_cloud_SW     : SW absorption coefficient of the cloud (0).
+            albedo         : Planetary albedo (0.3).
+            insolation     : irradiance at the atmosphere top (1370/4).
+        
+        The scenarios are grouped in batches. With processes > 1 the batches
+        are sent to a process pool, but at most max_pending batches are in 
+        flight: a new batch is read from the input only when the results
+        of the oldest one are consumed, so the memory stays bounded also
+        for an unbounded stream.
+        
+        (The default values are in parentheses)
+        
+        INPUT:
+            scenarios   : iterable of scenario dicts.
+            batch_size  : number of scenarios in each batch (100).
+            processes   : number of worker processes (1).
+            max_pending : maximum number of batches in flight (2*processes).
+            
+        OUTPUT:
+            generator of (ch_ir, ch_sw, z, T) tuples, one for each scenario.
+        
+        RAISE:
+            ValueError:
+                If batch_size, processes or max_pending are smaller than 1
+                
+                                                                          """
+    if max_pending is None:
+        max_pending = 2*processes
+        
+    if processes < 1 or max_pending < 1:
+        raise ValueError('processes and max_pending must be at least 1')
+        
+    batches = scenario_batches(scenarios, batch_size)
+    
+    def serial_pipeline():
+        for batch in batches:
+            yield from _run_scenario_batch(batch)
+            
+    def pool_pipeline():
+        pending = deque()
+        with multiprocessing.Pool(processes) as pool:
+            for batch in batches:
+                pending.append(pool.apply_async(_run_scenario_batch, (batch,)))
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().get()
+            while len(pending) > 0:
+                yield from pending.popleft().get()
+    
+    if processes == 1:
+        return serial_pipeline()
+    else:
+        return pool_pipeline()
+    
+    
+def write_temperature_txt(results, output_path_txt):
+    """ This function writes the temperature profiles in function of the 
+        height in a txt file. The results are consumed one at a time, so 
+        it can be used directly on the generator of model_pipeline.
+        
+        The profiles of different scenarios are separated by a blank line.
+        
+        INPUT:
+            results         : iterable of (ch_ir, ch_sw, z, T) tuples.
+            output_path_txt : path of the txt file.
+            
+        OUTPUT:
+            n : number of profiles written.
+                
+                                                                          """
+    header_file1 = 'In this file is presented the temperature in function of the height \n'
+    header_file2 = 'Height[m]  Temperature[K]'
+    header_file = header_file1 + header_file2
+    
+    n = 0
+    with open(output_path_txt, 'w') as file:
+        for _, _, z, T in results:
+            if n == 0:
+                np.savetxt(file, np.c_[z, T], fmt="%f", delimiter=" ",
+                           header = header_file)
+            else:
+                file.write('\n')
+                np.savetxt(file, np.c_[z, T], fmt="%f", delimiter=" ")
+            n = n + 1
+            
+    return n
+
+
+def _transmitted_sum(ch, emission):
+    """ Vectorized solution of the recursion
+    
+            y[0] = 0,  y[k] = exp(-ch[k-1])*y[k-1] + emission[k-1]
+            
+        i.e. the radiation emitted by the previous layers and transmitted
+        up to each layer. With s the cumulative OD, 
+        y[k] = exp(-s[k])*cumsum(exp(s[j+1])*emission[j]). To keep the 
+        exponentials finite the column is processed in chunks where s 
+        grows by at most ~400 (the OD of a layer is capped at 200, since
+        exp(-200) is already a zero transmittance).                     """
+    nlayer = len(ch)
+    y = np.zeros(nlayer)
+    
+    s = np.zeros(nlayer)
+    s[1:nlayer] = np.cumsum(np.minimum(ch[0:nlayer-1], 200))
+    
+    #Most columns are a single chunk
+    if s[nlayer-1] <= 400:
+        y[1:nlayer] = np.exp(-s[1:nlayer])*np.cumsum(np.exp(s[1:nlayer])*
+                                                     emission[0:nlayer-1])
+        return y
+    
+    c = 0
+    while c < nlayer - 1:
+        #last level of the chunk starting at c
+        e = min(int(np.searchsorted(s, s[c] + 200, side = 'right')), nlayer - 1)
+        s_rel = s[c+1:e+1] - s[c]
+        y[c+1:e+1] = np.exp(-s_rel)*(y[c] + np.cumsum(np.exp(s_rel)*emission[c:e]))
+        c = e
+        
+    return y
+
+
+def ir_exchange_product(ch_ir, x):
+    """This function computes the product M*x, with M the matrix given by
+       ir_exchange_matrix, without building the matrix.
+       
+       The elements of M are products of layer transmittances, so the sums
+       over the layers above and below each layer are two recursive sweeps,
+       computed with cumulative sums in O(nlayer) operations and memory.
+       
+       INPUT:
+           ch_ir  : Total optical depth vector in the IR region.
+           x      : vector of length nlayer (example: sigma*T^4).
+           
+       OUTPUT:
+           Mx : the vector M*x.
+
+                                                                        """
+    nlayer = len(ch_ir)
+    
+    #Transmittance, absorbance and emissivity as in ir_exchange_matrix
+    trans_ir = np.exp(-ch_ir)
+    trans_ir[nlayer - 1] = 0
+    abs_ir = 1 - trans_ir
+    emis_ir = abs_ir
+    
+    emission = emis_ir*x
+    
+    #Radiation reaching each layer from the layers above (down) and below (up)
+    from_above = _transmitted_sum(ch_ir, emission)
+    
+    #From below is the same sweep on the reversed column, the ground 
+    #transmittance is never used since nothing is below the ground
+    ch_reversed = ch_ir[::-1].copy()
+    ch_reversed[0] = 0
+    from_below = _transmitted_sum(ch_reversed, emission[::-1])[::-1]
+    
+    Mx = abs_ir*(from_below + from_above) - 2*emission
+    Mx[nlayer-1] = abs_ir[nlayer-1]*from_above[nlayer-1] - emission[nlayer-1]
+    
+    return Mx
+
+
+def coarse_optical_depth(ch, coarse_nlayer):
+    """This function aggregates an OD profile on a coarser grid.
+    
+       Since the OD is additive, the OD of a coarse layer is the sum of the
+       OD of the fine layers it contains. The top and the surface levels
+       are kept in both grids.
+       
+       INPUT:
+           ch            : optical depth profile vector (nlayer).
+           coarse_nlayer : number of layers of the coarse grid.
+           
+       OUTPUT:
+           ch_c  : optical depth profile vector on the coarse grid.
+           index : position of the coarse levels in the fine grid.
+       
+       RAISE:
+           ValueError:
+               If coarse_nlayer < 2 or coarse_nlayer > nlayer
+
+                                                                        """
+    nlayer = len(ch)
+    
+    if coarse_nlayer < 2 or coarse_nlayer > nlayer:
+        raise ValueError('coarse_nlayer must to be in [2, nlayer]!')
+        
+    index = np.unique(np.round(np.linspace(0, nlayer - 1, 
+                                           int(coarse_nlayer))).astype(int))
+    
+    #The last level is the surface, its OD is not summed
+    ch_c = np.zeros(len(index))
+    ch_c[0:len(index)-1] = np.add.reduceat(ch[0:nlayer-1], index[0:len(index)-1])
+    ch_c[len(index)-1] = ch[nlayer-1]
+    
+    return ch_c, index
+
+
+def temperature_profile_multigrid(ch_ir, ch_sw, albedo = 0.3, 
+                                  insolation = 1370/4, coarse_nlayer = 101,
+                                  tol = 1e-10, maxiter = 500):
+    """This function computes the atmospheric temperature vector in an
+       equilibrium situation with a coarse-to-fine solver, for columns with
+       a large number of layers.
+       
+       The OD profiles are aggregated on a coarse grid (coarse_optical_depth)
+       where the system is solved directly with temperature_profile. The 
+       coarse temperature is interpolated on the fine grid and used as 
+       initial guess of a preconditioned conjugate gradient on the fine 
+       system, which uses ir_exchange_product instead of the full matrix.
+       
+       The matrix -M is symmetric and diagonally dominant, so the iteration
+       converges. The iteration stops when the relative residual of the
+       energy balance is smaller than tol; if this does not happen within 
+       maxiter iterations the direct solution of temperature_profile is 
+       returned. Note that tol bounds the residual and not the error on T,
+       which can be up to cond(M) times larger.
+       
+       (The default values are in parentheses)
+       
+       INPUT:
+           ch_ir         : Total optical depth vector in the IR region.
+           ch_sw         : Total optical depth vector in the SW region.
+           albedo        : Planetary albedo (0.3).
+           insolation    : irradiance at the atmosphere top (1370/4).
+           coarse_nlayer : number of layers of the coarse grid (101).
+           tol           : tolerance on the relative residual of the
+                           energy balance (1e-10).
+           maxiter       : maximum number of fine iterations (500).
+           
+       OUTPUT:
+           T : Atmospheric temperature vector, gives the temperature at each
+               level of the atmosphere.
+       
+       RAISE:
+           ValueError:
+               As temperature_profile
+               If coarse_nlayer < 2
+
+                                                                        """
+    if (len(ch_ir) != len(ch_sw)):
+        raise ValueError('The length of ch_ir and ch_sw must to be equal!')
+        
+    if (len(ch_sw[ch_sw < 0]) != 0) or (len(ch_ir[ch_ir < 0]) != 0):
+        raise ValueError('ch_ir or ch_sw contain negative elements!')
+        
+    if (albedo < 0 or albedo > 1 or insolation < 0):
+        raise ValueError('albedo must to be in [0, 1] and insolation >= 0!')
+    
+    if coarse_nlayer < 2:
+        raise ValueError('coarse_nlayer must to be at least 2!')
+        
+    nlayer = len(ch_ir)
+    
+    #For small columns the direct solution is the cheapest
+    if nlayer <= coarse_nlayer:
+        return temperature_profile(ch_ir, ch_sw, albedo, insolation)
+    
+    sigma = 5.6704e-8            # [W/(m^2k^4)] Stefan Boltzmann Costant
+    TSI = (1 - albedo) * insolation
+    
+    #Coarse solution and interpolation on the fine grid 
+    ch_ir_c, index = coarse_optical_depth(ch_ir, coarse_nlayer)
+    ch_sw_c, _ = coarse_optical_depth(ch_sw, coarse_nlayer)
+    T_c = temperature_profile(ch_ir_c, ch_sw_c, albedo, insolation)
+    
+    #The surface (last level) is not interpolated with the atmosphere
+    T = np.interp(np.arange(nlayer - 1), index[0:len(index)-1], 
+                  T_c[0:len(index)-1])
+    T = np.append(T, T_c[len(index)-1])
+    
+    #Fine system: M*sT4 = -b, solved starting from the interpolated T
+    b = TSI*sw_absorption_profile(ch_sw)
+    sT4, converged = _exchange_cg(ch_ir, b, sigma*T**4, tol, maxiter)
+    
+    if not converged:
+        return temperature_profile(ch_ir, ch_sw, albedo, insolation)
+    
+    T = (sT4/sigma)**0.25
+    
+    return T
+
+
+def _exchange_cg(ch_ir, b, x, tol, maxiter):
+    """ Preconditioned (Jacobi) conjugate gradient for A*x = b, with
+        A = -M symmetric positive definite, starting from x. It returns the
+        last x and True if the relative residual is smaller than tol.    """
+    nlayer = len(ch_ir)
+    trans_ir = np.exp(-ch_ir)
+    trans_ir[nlayer - 1] = 0
+    diagonal = 2*(1 - trans_ir)
+    diagonal[nlayer - 1] = 1
+    
+    def A(x): return -ir_exchange_product(ch_ir, x)
+    
+    r = b - A(x)
+    z = r/diagonal
+    p = z.copy()
+    rz = np.dot(r, z)
+    b_norm = np.linalg.norm(b)
+    
+    for _ in range(maxiter):
+        if np.linalg.norm(r) <= tol*b_norm:
+            break
+        Ap = A(p)
+        alpha = rz/np.dot(p, Ap)
+        x = x + alpha*p
+        r = r - alpha*Ap
+        z = r/diagonal
+        rz_new = np.dot(r, z)
+        p = z + (rz_new/rz)*p
+        rz = rz_new
+        
+    return x, np.linalg.norm(r) <= tol*b_norm
+
+
+#Input parameters stored with each run: (name, dtype, default value)
+_PARAMETER_FIELDS = (('z_top_a', 'f8', 50), ('scale_height_1', 'f8', 5),
+                     ('scale_height_2', 'f8', 5), ('wp_1', 'S11', 'costant'),
+                     ('wp_2', 'S11', 'costant'), ('ozone', 'f8', 0),
+                     ('k_1_a', 'f8', 0.4), ('k_2_a', 'f8', 0),
+                     ('k_ozone_a', 'f8', 0), ('clouds', 'f8', 0),
+                     ('cloud_position', ('f8', (2,)), [8, 10]),
+                     ('k_cloud_LW', 'f8', 0.001), ('k_cloud_SW', 'f8', 0),
+                     ('albedo', 'f8', 0.3), ('insolation', 'f8', 1370/4))
+
+_PROFILE_FIELDS = ('z', 'T', 'ch_ir', 'ch_sw')
+
+
+def result_dtype(nlayer):
+    """ This function returns the structured dtype of a model run with 
+        nlayer layers: the input parameters followed by the z, T, ch_ir
+        and ch_sw profiles.                                             """
+    fields = [(name, dtype) for name, dtype, _ in _PARAMETER_FIELDS]
+    fields += [(name, 'f8', (int(nlayer),)) for name in _PROFILE_FIELDS]
+    return np.dtype(fields)
+
+
+def _result_record(scenario, result):
+    """ Builds the record of a run from its scenario dict and the 
+        (ch_ir, ch_sw, z, T) tuple given by model_pipeline.             """
+    ch_ir, ch_sw, z, T = result
+    parameters = tuple(scenario.get(name, default) 
+                       for name, _, default in _PARAMETER_FIELDS)
+    return parameters + (z, T, ch_ir, ch_sw)
+
+
+class ModelResults:
+    """ Container of the results of many model runs.
+    
+        All the runs are stored in a single structured numpy array (see 
+        result_dtype), one record per run with the input parameters and
+        the z, T, ch_ir, ch_sw profiles. There are no per-run objects, so
+        the memory used is essentially the one of the floats.
+        
+        The profiles are numpy views of the buffer (results.T is a 
+        (n_runs x nlayer) array), slicing returns a ModelResults that
+        shares the buffer and save/load use the .npy binary format, with
+        load mapping the file in memory instead of reading it.
+        
+        Iterating over the container gives (ch_ir, ch_sw, z, T) tuples,
+        so it can be passed to write_temperature_txt.
+                                                                          """
+    __slots__ = ('data',)
+    
+    def __init__(self, data):
+        """ data : 1D structured array with the dtype given by result_dtype.
+                                                                          """
+        data = np.asanyarray(data)
+        
+        if data.ndim != 1 or data.dtype.names is None:
+            raise ValueError('data must to be a 1D structured array!')
+            
+        self.data = data
+        
+    @classmethod
+    def from_runs(cls, scenarios, results):
+        """ Builds the container from the scenario dicts and the 
+            corresponding (ch_ir, ch_sw, z, T) tuples. All the runs must 
+            have the same number of layers.                               """
+        records = (_result_record(scenario, result) 
+                   for scenario, result in zip(scenarios, results))
+        
+        first = next(records, None)
+        if first is None:
+            raise ValueError('At least one run is needed!')
+        
+        dtype = result_dtype(len(first[len(first) - 1]))
+        data = np.fromiter(itertools.chain([first], records), dtype = dtype)
+        
+        return cls(data)
+    
+    @classmethod
+    def from_pipeline(cls, scenarios, **pipeline_options):
+        """ Runs model_pipeline on the scenarios (the options are passed to
+            it) and stores the results directly in the container.        """
+        scenarios, pipeline_scenarios = itertools.tee(scenarios)
+        results = model_pipeline(pipeline_scenarios, **pipeline_options)
+        
+        return cls.from_runs(scenarios, results)
+    
+    @classmethod
+    def concatenate(cls, results):
+        """ Joins several containers in a new one (a single copy of the 
+            data in one buffer).                                          """
+        return cls(np.concatenate([result.data for result in results]))
+    
+    @classmethod
+    def load(cls, path, mmap_mode = 'r'):
+        """ Loads a container saved with save. With mmap_mode (default 'r')
+            the file is mapped in memory and not read.                    """
+        return cls(np.load(path, mmap_mode = mmap_mode))
+    
+    def save(self, path):
+        """ Saves the buffer in the .npy binary format.                   """
+        np.save(path, self.data)
+        
+    def scenario(self, run):
+        """ Returns the scenario dict of a run (see model_pipeline).      """
+        record = self.data[run]
+        scenario = {'nlayer': self.nlayer}
+        for name, _, _ in _PARAMETER_FIELDS:
+            value = record[name]
+            if isinstance(value, bytes):
+                value = value.decode()
+            elif np.ndim(value) == 0:
+                value = value.item()
+            else:
+                value = value.tolist()
+            scenario[name] = value
+        return scenario
+        
+    @property
+    def nlayer(self):
+        return self.data.dtype['z'].shape[0]
+        
+    @property
+    def z(self):
+        return self.data['z']
+    
+    @property
+    def T(self):
+        return self.data['T']
+    
+    @property
+    def ch_ir(self):
+        return self.data['ch_ir']
+    
+    @property
+    def ch_sw(self):
+        return self.data['ch_sw']
+        
+    def __len__(self):
+        return len(self.data)
+    
+    def __getitem__(self, key):
+        """ A field name gives the corresponding array, an int the record 
+            of the run, a slice or an index array a new ModelResults.    """
+        if isinstance(key, str) or isinstance(key, (int, np.integer)):
+            return self.data[key]
+        return ModelResults(self.data[key])
+        
+    def __iter__(self):
+        for record in self.data:
+            yield record['ch_ir'], record['ch_sw'], record['z'], record['T']
+            
+    def __repr__(self):
+        return f'ModelResults(n_runs = {len(self)}, nlayer = {self.nlayer})'
+
+
+
+def _two_stream_emission(ch_ir, g):
+    """ Gray two-stream sigma*T^4 of each layer for the absorbed irradiance
+        g (the last element is absorbed by the ground), see 
+        temperature_profile_two_stream.                                 """
+    nlayer = len(ch_ir)
+    
+    #Net flux at the top of each layer (all that is absorbed below it)
+    F = np.cumsum(g[::-1])[::-1]
+    
+    #Integral of F in the IR optical depth for each layer (trapezoid)
+    F_bottom = np.append(F[1:nlayer], F[nlayer-1])
+    F_int = 0.5*(F + F_bottom)*ch_ir
+    tot_F_int = np.zeros(nlayer)
+    tot_F_int[1:nlayer] = np.cumsum(F_int[0:nlayer-1])
+    
+    #Sum of the IR fluxes in the middle of each layer
+    Sigma = F[0] + tot_F_int + 0.5*F_int
+    
+    #Emissivity of the layers (the last layer is the black body ground)
+    emis_ir = 1 - np.exp(-ch_ir)
+    emis_ir[nlayer - 1] = 1
+    
+    sT4 = 0.5*(Sigma + g/emis_ir)
+    sT4[nlayer-1] = 0.5*(F[0] + tot_F_int[nlayer-1] + g[nlayer-1])
+    
+    return sT4
+
+
+def _two_stream_error_bound(ch_ir, q, sT4):
+    """ Componentwise bound d of |sT4_exact - sT4|.
+    
+        A = -M is a Z-matrix with A*1 = emis_ir*exp(-tot_ch_ir) > 0, so its
+        inverse is >= 0 and, for the residual r = q - A*sT4, any v >= 0
+        with A*v >= |r| gives |sT4_exact - sT4| = |A^-1*r| <= v. The v used
+        is c*w + beta, with w the two-stream solution for the forcing |r|
+        (refined once), c chosen among a few values and beta the smallest
+        value that covers the layers where c*A*w < |r|.                 """
+    nlayer = len(ch_ir)
+    
+    r = q + ir_exchange_product(ch_ir, sT4)
+    r_abs = np.abs(r)
+    
+    w = _two_stream_emission(ch_ir, r_abs)
+    Aw = -ir_exchange_product(ch_ir, w)
+    w = w + _two_stream_emission(ch_ir, np.maximum(r_abs - Aw, 0) + 0.1*r_abs)
+    Aw = -ir_exchange_product(ch_ir, w)
+    
+    #A*1, the part of the layer emission that escapes to space
+    tot_ch_ir = np.zeros(nlayer)
+    tot_ch_ir[1:nlayer] = np.cumsum(ch_ir[0:nlayer-1])
+    emis_ir = 1 - np.exp(-ch_ir)
+    emis_ir[nlayer - 1] = 1
+    A1 = emis_ir*np.exp(-tot_ch_ir)
+    
+    #The candidates of c are evaluated together, one for each row
+    c = np.array([[1], [1.1], [1.25], [1.5], [2], [3]])
+    with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+        deficit = np.maximum(r_abs - c*Aw, 0)
+        beta = np.max(np.where(deficit > 0, deficit/A1, 0), axis = 1)
+        d = c*w + beta[:, None]
+        best = np.argmin(np.max(d/sT4, axis = 1))
+                
+    return d[best]
+
+
+def temperature_profile_two_stream(ch_ir, ch_sw, albedo = 0.3, 
+                                   insolation = 1370/4, threshold = None,
+                                   error_bound = True):
+    """This function computes an approximate atmospheric temperature vector
+       with the gray two-stream (Schwarzschild) equations, in O(nlayer) 
+       operations and without the M matrix. It is meant for screening 
+       studies.
+       
+       With tau the cumulative IR optical depth (tot_ch_ir) and 
+       S(tau) = TSI*exp(-tot_ch_sw) the net solar flux, the sum of the 
+       upward and downward IR fluxes is Sigma = TSI + integral(S dtau), 
+       and the emission of each layer is
+       
+           sigma*T^4 = (Sigma + q/emis)/2
+           
+       with q the solar irradiance absorbed by the layer. The surface emits
+       sigma*T^4 = (Sigma + S)/2 at the bottom.
+       
+       The error is an a-posteriori bound of the deviation from the exact
+       solution, obtained from the residual of the exact system with three
+       O(n) products (see _two_stream_error_bound); it is never smaller 
+       than the real deviation, and usually a few times larger. 
+       
+       If threshold is given and the bound exceeds it, the exact solution
+       is computed with temperature_profile_multigrid: if the real deviation is within the threshold the approximate T is
+       kept and the real deviation is returned as error, otherwise the 
+       exact T is returned together with an error of 0.
+       
+       (The default values are in parentheses)
+       
+       INPUT:
+           ch_ir       : Total optical depth vector in the IR region.
+           ch_sw       : Total optical depth vector in the SW region.
+           albedo      : Planetary albedo (0.3).
+           insolation  : irradiance at the atmosphere top (1370/4).
+           threshold   : maximum accepted deviation in K (None, never exact).
+           error_bound : if False and threshold is None the bound is not
+                         computed and the error is None (True).
+           
+       OUTPUT:
+           T     : Atmospheric temperature vector.
+           error : maximum deviation from the exact T in K (upper bound).
+       
+       RAISE:
+           ValueError:
+               As temperature_profile
+               If an atmospheric layer (not the surface) has ch_ir == 0,
+               since a transparent layer can not emit
+
+                                                                        """
+    if (len(ch_ir) != len(ch_sw)):
+        raise ValueError('The length of ch_ir and ch_sw must to be equal!')
+        
+    if (len(ch_sw[ch_sw < 0]) != 0) or (len(ch_ir[ch_ir < 0]) != 0):
+        raise ValueError('ch_ir or ch_sw contain negative elements!')
+        
+    if (albedo < 0 or albedo > 1 or insolation < 0):
+        raise ValueError('albedo must to be in [0, 1] and insolation >= 0!')
+        
+    sigma = 5.6704e-8            # [W/(m^2k^4)] Stefan Boltzmann Costant
+    TSI = (1 - albedo) * insolation
+    nlayer = len(ch_ir)
+    
+    #The last layer is the ground, which is a black body for any ch_ir
+    if np.any(ch_ir[0:nlayer-1] == 0):
+        raise ValueError('ch_ir must to be > 0 in the atmospheric layers!')
+    
+    #Solar irradiance absorbed by each layer, the rest goes to the ground
+    q = TSI*sw_absorption_profile(ch_sw)
+    
+    sT4 = _two_stream_emission(ch_ir, q)
+    T = (sT4/sigma)**0.25
+    
+    if threshold is None and not error_bound:
+        return T, None
+    
+    #Bound of the deviation from the exact solution in K
+    d = _two_stream_error_bound(ch_ir, q, sT4)
+    T_up = ((sT4 + d)/sigma)**0.25
+    T_down = (np.maximum(sT4 - d, 0)/sigma)**0.25
+    error = np.max(np.maximum(T_up - T, T - T_down))
+    
+    #(written to switch also when the bound is not a number)
+    if threshold is not None and not error <= threshold:
+        T_exact = temperature_profile_multigrid(ch_ir, ch_sw, albedo, 
+                                                insolation)
+        error = np.max(np.abs(T - T_exact))
+        if not error <= threshold:
+            T = T_exact
+            error = 0
+    
+    return T, error
@@ -75,7 +75,8 @@ else:
 
 
 #generation of the temperature profile vector from the OD 
-T = at.temperature_profile(ch_ir, ch_sw)
+#(for more than 101 layers it is used the coarse-to-fine solver)
+T = at.temperature_profile_multigrid(ch_ir, ch_sw)
 
 #Definition of the output Path
 output_path = parser.get('Output_Path', 'output_path_graph',
@@ -127,12 +128,8 @@ def temperature_txt():
                                                                     '''
     name_file = 'Temperature_Profile'
     output_path_txt = output_path + name_file
-    header_file1 = 'In this file is presented the temperature in function of the height \n'
-    header_file2 = 'Height[m]  Temperature[K]'
-    header_file = header_file1 + header_file2
         
-    np.savetxt(f'{output_path_txt}.txt',  np.c_[z, T], fmt="%f", 
-               delimiter=" ", header = header_file)
+    at.write_temperature_txt([(ch_ir, ch_sw, z, T)], f'{output_path_txt}.txt')
     
     
     
@@ -1,5 +1,8 @@
 #Testing section of Atm_Temperature functions
 
+import itertools
+import pickle
+import timeit
 import numpy as np
 import Atm_T_Functions as at
 import pytest
@@ -183,6 +186,377 @@ def test_temperature_profile(nlayer):
         at.temperature_profile(np.array([1,2]), np.array([1]))
     
 
+#Test for the function "column_insolation"
+@given(declination = st.floats(-23.5,23.5), hour_angle = st.floats(-180,180))
+@settings(max_examples = 5)
+def test_column_insolation(declination, hour_angle):
+    
+    lat = np.linspace(-90, 90, 37)
+    Q = at.column_insolation(lat, declination)
+    Q_inst = at.column_insolation(lat, declination, hour_angle)
+    
+    #check that the outputs have the correct length
+    assert(len(Q) == len(Q_inst) == len(lat))
+    
+    #check that outputs do not contain negative elements
+    assert(len(Q[Q < 0]) == 0)
+    assert(len(Q_inst[Q_inst < 0]) == 0)
+    
+    #check that the global mean of the daily insolation at the equinox is S/4
+    lat = np.arange(-89.5, 90, 1)
+    Q = at.column_insolation(lat)
+    assert(np.isclose(np.average(Q, weights = np.cos(np.radians(lat))),
+                      1370/4, rtol = 1e-3))
+    
+    with pytest.raises(ValueError):
+        #check that a latitude outside [-90, 90] raises a ValueError
+        at.column_insolation(np.array([100]))
+        
+
+
+#Test for the function "temperature_profile_columns"
+@given(nlayer = st.integers(1,51), albedo = st.floats(0,1))
+@settings(max_examples = 5, deadline = None)
+def test_temperature_profile_columns(nlayer, albedo):
+    
+    np.random.seed(30)
+    ch_ir = np.random.rand(nlayer)
+    ch_sw = np.random.rand(nlayer)
+    insolation = np.random.rand(4, 3)*400
+    
+    T = at.temperature_profile_columns(ch_ir, ch_sw, albedo, insolation)
+    
+    #check that the output has the shape of the grid
+    assert(T.shape == (4, 3, nlayer))
+    
+    #check that each column is equal to the single column solution
+    assert(np.allclose(T[1, 2], at.temperature_profile(ch_ir, ch_sw, albedo,
+                                                       insolation[1, 2])))
+    
+    #check the columns with different IR optical depth
+    ch_ir_grid = np.array([ch_ir, 2*ch_ir, ch_ir])
+    T = at.temperature_profile_columns(ch_ir_grid, ch_sw, albedo, 300)
+    assert(np.allclose(T[0], T[2]))
+    assert(np.allclose(T[1], at.temperature_profile(2*ch_ir, ch_sw, albedo, 300)))
+    
+    #check that the worker processes give the serial result
+    T_pool = at.temperature_profile_columns(ch_ir_grid, ch_sw, albedo, 300,
+                                            processes = 2)
+    assert(np.allclose(T_pool, T))
+    
+    with pytest.raises(ValueError):
+        #check that an albedo greater than 1 raises a ValueError
+        at.temperature_profile_columns(ch_ir, ch_sw, np.array([0.5, 1.5]))
+    
+
+#Test for the functions "shared_result_buffers" and "write_shared_result"
+@given(n_runs = st.integers(1,10), nlayer = st.integers(1,51))
+@settings(max_examples = 5)
+def test_shared_result_buffers(n_runs, nlayer):
+    
+    with at.shared_result_buffers(n_runs, nlayer) as (buffers, spec):
+        #check that the buffers have the correct shape and start from zero
+        assert(buffers['T'].shape == (n_runs, nlayer))
+        assert(np.count_nonzero(buffers['T']) == 0)
+        
+        #check that what is written through the spec is seen by the arrays
+        at.write_shared_result(spec, n_runs - 1, T = np.ones(nlayer))
+        assert(np.all(buffers['T'][n_runs - 1] == 1))
+    
+    #check that the arrays remain valid after the block
+    assert(buffers['T'].sum() == nlayer)
+    
+    with pytest.raises(ValueError):
+        #check that an empty buffer raises a ValueError
+        with at.shared_result_buffers(0, nlayer):
+            pass
+
+
+
+#Test for the function "parallel_model_runs"
+def test_parallel_model_runs():
+    
+    parameters = [{'nlayer': 21, 'k_1_a': k} for k in [0.4, 0.8, 1.2]]
+    T, ch_ir, ch_sw, z = at.parallel_model_runs(parameters, processes = 2)
+    
+    #check that the outputs have the shape (n_runs x nlayer)
+    assert(T.shape == ch_ir.shape == ch_sw.shape == z.shape == (3, 21))
+    
+    #check that each run is equal to the serial one
+    ch_ir_1, ch_sw_1, z_1 = at.optical_depth(nlayer = 21, k_1_a = 0.8)
+    assert(np.allclose(ch_ir[1], ch_ir_1))
+    assert(np.allclose(T[1], at.temperature_profile(ch_ir_1, ch_sw_1)))
+    
+    with pytest.raises(ValueError):
+        #check that runs with different nlayer raise a ValueError
+        at.parallel_model_runs([{'nlayer': 21}, {'nlayer': 11}])
+    
+
+#Test for the function "scenario_batches"
+@given(n = st.integers(0,50), batch_size = st.integers(1,10))
+@settings(max_examples = 5)
+def test_scenario_batches(n, batch_size):
+    
+    batches = list(at.scenario_batches(range(n), batch_size))
+    
+    #check that the batches contain all the scenarios in order
+    assert(sum(batches, []) == list(range(n)))
+    #check that the batches are not longer than batch_size
+    assert(all(len(batch) <= batch_size for batch in batches))
+    
+    #check that an unbounded stream is read lazily
+    first = next(at.scenario_batches(itertools.count(), batch_size))
+    assert(first == list(range(batch_size)))
+    
+    with pytest.raises(ValueError):
+        #check that batch_size < 1 raises a ValueError
+        at.scenario_batches(range(n), 0)
+
+
+
+#Test for the functions "model_pipeline" and "write_temperature_txt"
+@given(processes = st.integers(1,2), batch_size = st.integers(1,5))
+@settings(max_examples = 3, deadline = None)
+def test_model_pipeline(processes, batch_size, tmp_path_factory):
+    
+    def scenarios():
+        for k in itertools.count():
+            yield {'nlayer': 11, 'k_1_a': 0.1*(k + 1), 'clouds': k % 2,
+                   'cloud_position': [8, 10]}
+    
+    #check that the pipeline works on an unbounded stream
+    pipeline = at.model_pipeline(scenarios(), batch_size, processes)
+    results = list(itertools.islice(pipeline, 7))
+    pipeline.close()
+    assert(len(results) == 7)
+    
+    #check that the results are in the order of the scenarios
+    ch_ir, ch_sw, z = at.optical_depth(nlayer = 11, k_1_a = 0.1*3)
+    assert(np.allclose(results[2][2], z))
+    assert(np.allclose(results[2][3], at.temperature_profile(ch_ir, ch_sw)))
+    
+    #check that the results can be streamed to disk
+    path = tmp_path_factory.mktemp('pipeline') / 'Temperature_Profile.txt'
+    scenario = itertools.islice(scenarios(), 5)
+    n = at.write_temperature_txt(at.model_pipeline(scenario, batch_size), path)
+    assert(n == 5)
+    assert(np.loadtxt(path).shape == (5*11, 2))
+    
+    with pytest.raises(ValueError):
+        #check that processes < 1 raises a ValueError
+        at.model_pipeline(scenarios(), batch_size, processes = 0)
+    
+
+#Test for the function "ir_exchange_product"
+@given(nlayer = st.integers(1,51))
+@settings(max_examples = 5)
+def test_ir_exchange_product(nlayer):
+    
+    np.random.seed(30)
+    ch_ir = np.random.rand(nlayer)
+    x = np.random.rand(nlayer)
+    
+    #check that the product is equal to the one with the full matrix
+    assert(np.allclose(at.ir_exchange_product(ch_ir, x),
+                       np.dot(at.ir_exchange_matrix(ch_ir), x)))
+
+
+
+#Test for the function "coarse_optical_depth"
+@given(nlayer = st.integers(2,101), coarse_nlayer = st.integers(2,101))
+@settings(max_examples = 5)
+def test_coarse_optical_depth(nlayer, coarse_nlayer):
+    
+    np.random.seed(30)
+    ch = np.random.rand(nlayer)
+    
+    if coarse_nlayer > nlayer:
+        with pytest.raises(ValueError):
+            at.coarse_optical_depth(ch, coarse_nlayer)
+        return
+    
+    ch_c, index = at.coarse_optical_depth(ch, coarse_nlayer)
+    
+    #check that the top and the surface are kept
+    assert(index[0] == 0 and index[len(index) - 1] == nlayer - 1)
+    assert(ch_c[len(ch_c) - 1] == ch[nlayer - 1])
+    
+    #check that the total OD of the atmosphere is conserved
+    assert(np.isclose(sum(ch_c), sum(ch)))
+    
+    
+    
+#Test for the function "temperature_profile_multigrid"
+@given(nlayer = st.integers(102,401), clouds = st.integers(0,1))
+@settings(max_examples = 3, deadline = None)
+def test_temperature_profile_multigrid(nlayer, clouds):
+    
+    ch_ir, ch_sw, z = at.optical_depth(nlayer, 50, 10, 5, 'costant', 'costant',
+                                       1, 1.2, 0.005, 0.002)
+    if clouds == 1:
+        ch_ir, ch_sw = at.clouds_optical_depth(ch_ir, ch_sw, 50, [8, 10], 
+                                               0.01, 0.001)
+    
+    T = at.temperature_profile_multigrid(ch_ir, ch_sw, coarse_nlayer = 51)
+    
+    #check that the solution is equal to the direct one
+    assert(np.allclose(T, at.temperature_profile(ch_ir, ch_sw)))
+    
+    #check that also without convergence the direct solution is returned
+    T = at.temperature_profile_multigrid(ch_ir, ch_sw, coarse_nlayer = 51,
+                                         maxiter = 0)
+    assert(np.allclose(T, at.temperature_profile(ch_ir, ch_sw)))
+    
+    with pytest.raises(ValueError):
+        #check that coarse_nlayer < 2 raises a ValueError
+        at.temperature_profile_multigrid(ch_ir, ch_sw, coarse_nlayer = 1)
+    
+
+#Test for the class "ModelResults"
+@given(n_runs = st.integers(1,6), nlayer = st.integers(2,31))
+@settings(max_examples = 3, deadline = None)
+def test_model_results(n_runs, nlayer, tmp_path_factory):
+    
+    scenarios = [{'nlayer': nlayer, 'k_1_a': 0.2*(k + 1), 'wp_1': 'exponential'}
+                 for k in range(n_runs)]
+    results = at.ModelResults.from_pipeline(scenarios, batch_size = 2)
+    
+    #check that the profiles are (n_runs x nlayer) arrays
+    assert(len(results) == n_runs)
+    assert(results.T.shape == results.z.shape == (n_runs, nlayer))
+    
+    #check that the stored parameters reproduce the run
+    ch_ir, ch_sw, z, T = at._run_scenario(results.scenario(n_runs - 1))
+    assert(results.scenario(n_runs - 1)['wp_1'] == 'exponential')
+    assert(np.allclose(results.T[n_runs - 1], T))
+    
+    #check that the slices share the buffer
+    assert(np.shares_memory(results[0:].data, results.data))
+    
+    #check that the save/load cycle does not change the data
+    path = tmp_path_factory.mktemp('results') / 'results.npy'
+    results.save(path)
+    loaded = at.ModelResults.load(path)
+    assert(np.array_equal(loaded.T, results.T))
+    
+    #check the concatenation and the use with write_temperature_txt
+    joined = at.ModelResults.concatenate([results, loaded])
+    assert(len(joined) == 2*n_runs)
+    path = tmp_path_factory.mktemp('results') / 'Temperature_Profile.txt'
+    assert(at.write_temperature_txt(joined, path) == 2*n_runs)
+    
+    with pytest.raises(ValueError):
+        #check that a container without runs raises a ValueError
+        at.ModelResults.from_runs([], [])
+    
+
+#Test for the function "temperature_profile_two_stream"
+@given(nlayer = st.integers(1,51), k_1_a = st.floats(0.1,5))
+@settings(max_examples = 5)
+def test_temperature_profile_two_stream(nlayer, k_1_a):
+    
+    ch_ir, ch_sw, z = at.optical_depth(nlayer, 50, 10, 5, 'costant', 'costant',
+                                       1, k_1_a, 0.005, 0.002)
+    
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw)
+    
+    #check if the output length is the correct
+    assert(len(T) == nlayer)
+    
+    #check that outputs do not contain negative elements
+    assert(len(T[T < 0]) == 0)
+    assert(error >= 0)
+    
+    #check that with a zero threshold the exact solution is returned
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw, threshold = 0)
+    assert(error == 0)
+    assert(np.allclose(T, at.temperature_profile(ch_ir, ch_sw)))
+    
+    #check that without bound the error is not computed
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw, error_bound = False)
+    assert(error is None)
+    
+    with pytest.raises(ValueError):
+        #check that when there is a negative element on the input an error arise
+        at.temperature_profile_two_stream(ch_ir - 1, ch_sw)
+        
+    with pytest.raises(ValueError):
+        #check that a transparent atmospheric layer raises a ValueError
+        ch_ir, ch_sw, z = at.optical_depth(51, k_1_a = 0, k_2_a = 0.005)
+        at.temperature_profile_two_stream(ch_ir, ch_sw, threshold = 0.5)
+        
+        
+        
+#Test for the error bound of "temperature_profile_two_stream" with clouds
+#and thick layers
+@given(nlayer = st.integers(11,120), k_1_a = st.floats(0.1,6),
+       cloud_position = tuples(st.floats(0,10), st.floats(6,15)),
+       k_cloud_LW = st.floats(0,0.5), threshold = st.floats(0.5,5))
+@settings(max_examples = 20, deadline = None)
+def test_two_stream_error_bound(nlayer, k_1_a, cloud_position, k_cloud_LW,
+                                threshold):
+    
+    cloud_position = [cloud_position[0], sum(cloud_position)]
+    ch_ir, ch_sw, z = at.optical_depth(nlayer, 50, 10, 5, 'costant', 'costant',
+                                       0, k_1_a, 0.005, 0)
+    ch_ir, ch_sw = at.clouds_optical_depth(ch_ir, ch_sw, 50, cloud_position,
+                                           k_cloud_LW, 0)
+    T_exact = at.temperature_profile(ch_ir, ch_sw)
+    
+    #check that the bound is never smaller than the real deviation
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw)
+    assert(np.max(np.abs(T - T_exact)) <= error)
+    
+    #check that the returned profile is within the threshold and the error
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw, 
+                                                 threshold = threshold)
+    assert(np.max(np.abs(T - T_exact)) <= threshold + 1e-6)
+    assert(np.max(np.abs(T - T_exact)) <= error + 1e-6)
+    
+    #cloudy column with thick layers where the deviation is about 4 K
+    ch_ir, ch_sw, z = at.optical_depth(69, 50, 10, 5, 'costant', 'costant',
+                                       0, 5, 0.005, 0)
+    ch_ir, ch_sw = at.clouds_optical_depth(ch_ir, ch_sw, 50, [2, 12], 0.3, 0)
+    T_exact = at.temperature_profile(ch_ir, ch_sw)
+    
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw)
+    assert(np.max(np.abs(T - T_exact)) <= error)
+    
+    #check that with a threshold below the deviation the exact T is returned
+    T, error = at.temperature_profile_two_stream(ch_ir, ch_sw, threshold = 3.7)
+    assert(error == 0)
+    assert(np.allclose(T, T_exact))
+    
+
+#Test for the functions "attach_shared_results" and "detach_shared_results"
+def test_attach_shared_results():
+    
+    nlayer = 51
+    run = tuple(np.random.rand(nlayer) for _ in range(4))
+    
+    with at.shared_result_buffers(10, nlayer) as (buffers, spec):
+        at.attach_shared_results(spec)
+        
+        #check that the attached buffers are written in place
+        at.write_shared_result(spec, 3, T = run[0], ch_ir = run[1],
+                               ch_sw = run[2], z = run[3])
+        assert(np.array_equal(buffers['T'][3], run[0]))
+        assert(np.array_equal(buffers['z'][3], run[3]))
+        
+        #check that writing a run costs less than pickling it back to the
+        #parent (about 14 us against 43 us at nlayer = 51)
+        def write():
+            at.write_shared_result(spec, 3, T = run[0], ch_ir = run[1],
+                                   ch_sw = run[2], z = run[3])
+        def round_trip():
+            pickle.loads(pickle.dumps(run))
+        t_write = min(timeit.repeat(write, number = 1000, repeat = 5))
+        t_pickle = min(timeit.repeat(round_trip, number = 1000, repeat = 5))
+        assert(t_write < t_pickle)
+        
+        at.detach_shared_results(spec)
+    
+
 
 if __name__ == '__main__':
     pass